@@ -9,17 +9,29 @@ import time
 import hmac
 import hashlib
 import base64
-import uuid
+import binascii
+import secrets
 import threading
+import functools
+import itertools
 import os
 import re
 import shutil
 import mimetypes
+import logging
+import atexit
+import httpx
+import orjson
+import pybase64
 import requests
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
 from pathlib import Path
+from types import MappingProxyType
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Iterable, Iterator, Mapping, BinaryIO
 from flask import Flask, request, Response, jsonify, send_from_directory, abort
 from flask_cors import CORS
 
@@ -33,7 +45,26 @@ CONFIG_FILE = Path(__file__).parent / "business_gemini_session.json"
 # 图片缓存配置
 IMAGE_CACHE_DIR = Path(__file__).parent / "image"
 IMAGE_CACHE_HOURS = 1  # 图片缓存时间（小时）
+IMAGE_CLEANUP_INTERVAL = 3600  # 后台清理过期图片的间隔（秒）
+FILE_DOWNLOAD_WORKERS = 8  # 并发下载生成图片的最大线程数
 IMAGE_CACHE_DIR.mkdir(exist_ok=True)
+IMAGE_CACHE_ROOT = IMAGE_CACHE_DIR.resolve()  # 规范化后的缓存目录，用于路径遍历检查
+IMAGE_ETAG_SUFFIX = ".etag"  # 图片旁边保存 sha256 ETag 的文件后缀
+IMAGE_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+
+# 图片MIME类型与文件扩展名的对应关系
+IMAGE_EXT_MAP = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+IMAGE_EXTS = tuple(IMAGE_EXT_MAP.values())
+# 提供缓存图片时由扩展名推断Content-Type，注册到mimetypes，不依赖系统的mime数据库
+# （例如 Python 3.11 内置表中没有 .webp）
+for mime, ext in [*IMAGE_EXT_MAP.items(), ("image/jpeg", ".jpeg")]:
+    mimetypes.add_type(mime, ext)
+del mime, ext
 
 # API endpoints
 BASE_URL = "https://biz-discoveryengine.googleapis.com/v1alpha/locations/global"
@@ -43,6 +74,43 @@ LIST_FILE_METADATA_URL = f"{BASE_URL}/widgetListSessionFileMetadata"
 ADD_CONTEXT_FILE_URL = f"{BASE_URL}/widgetAddContextFile"
 GETOXSRF_URL = "https://business.gemini.google/auth/getoxsrf"
 
+# 请求头中除 authorization 外的固定部分
+BASE_HEADERS = MappingProxyType({
+    "accept": "*/*",
+    "accept-encoding": "gzip, deflate, br, zstd",
+    "accept-language": "zh-CN,zh;q=0.9,en;q=0.8",
+    "content-type": "application/json",
+    "origin": "https://business.gemini.google",
+    "referer": "https://business.gemini.google/",
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36",
+    "x-server-timeout": "1800",
+})
+
+# HTTP连接池配置
+HTTP_POOL_CONNECTIONS = 4  # 缓存的主机连接池数量
+HTTP_POOL_MAXSIZE = 32  # 每个主机保持的最大连接数
+STREAM_TIMEOUT = 120  # 流式对话请求超时（秒）
+PROXY_CHECK_TTL = 10  # 代理检测结果的缓存时间（秒）
+CONFIG_SAVE_DELAY = 0.5  # 配置修改后延迟写盘的时间（秒），期间的多次修改合并为一次写入
+
+# JWT配置
+JWT_REFRESH_MARGIN = 30  # JWT剩余有效期低于该值（秒）时刷新
+JWT_WARM_INTERVAL = 60  # 后台预热间隔（秒）
+JWT_WARM_TTL = 120  # 后台预热时，剩余有效期低于该值（秒）即预先刷新
+JWT_WARM_WORKERS = 8  # 并发刷新的最大线程数
+
+# 文件上传时每块读取的字节数（3的倍数，使各块的base64可直接拼接）
+UPLOAD_CHUNK_SIZE = 57 * 1024
+
+# 流式响应中的JSON词法单元：完整字符串或括号
+JSON_TOKEN_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]')
+
+# kQ编码中需要输出两个字节的字符
+WIDE_CHAR_RE = re.compile(r'[^\x00-\xff]+')
+
+# 日志（调试信息默认不输出，避免热路径上的格式化和stdout锁竞争）
+logger = logging.getLogger("gemini")
+
 # Flask应用
 app = Flask(__name__, static_folder='.')
 CORS(app)
@@ -54,9 +122,56 @@ class AccountManager:
     def __init__(self):
         self.config = None
         self.accounts = []  # 账号列表
-        self.current_index = 0  # 当前轮训索引
+        self.round_robin = itertools.count()  # 轮训计数器，next() 在GIL下是原子操作
         self.account_states = {}  # 账号状态: {index: {jwt, jwt_time, session, available}}
+        self.available_snapshot = ()  # 可用账号快照 ((index, account), ...)，仅在可用状态变化时重建
         self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # 保护 dirty / save_timer
+        self.dirty = False  # 配置是否有尚未写盘的修改
+        self.save_timer = None
+        self.http = self.create_http_session()
+        self.stream_proxy = None  # stream_client 当前使用的代理
+        self.stream_client = self.create_stream_client(None)  # 流式对话使用的HTTP/2客户端
+        self.image_base_url = ""  # 规范化后的图片基础URL（以 / 结尾），未配置时为空
+        self.models_response = None  # 序列化后的 /v1/models 响应，配置修改时清空
+    
+    @staticmethod
+    def create_http_session() -> requests.Session:
+        """创建共享的HTTP会话，复用TCP/TLS连接"""
+        session = requests.Session()
+        # 不保存响应中的cookie，避免不同账号之间串用
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                              pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    
+    @staticmethod
+    def create_stream_client(proxy: Optional[str]) -> httpx.Client:
+        """创建流式对话使用的HTTP/2客户端，多个并发对话复用同一个TLS连接"""
+        return httpx.Client(http2=True, verify=False, proxy=proxy or None,
+                            timeout=httpx.Timeout(STREAM_TIMEOUT))
+    
+    def set_proxy(self, proxy: Optional[str]):
+        """设置上游请求使用的代理，各请求函数不再单独传入"""
+        self.http.proxies = {"http": proxy, "https": proxy} if proxy else {}
+        # requests 中环境变量 HTTP(S)_PROXY 优先于 Session.proxies，配置了代理时不读取环境变量
+        self.http.trust_env = not proxy
+        # httpx 的代理在创建客户端时确定，只在代理变化时重建。
+        # 旧客户端上可能还有进行中的流式对话，不主动关闭，等这些请求结束释放引用后由GC回收
+        proxy = proxy or None
+        if proxy != self.stream_proxy:
+            self.stream_client = self.create_stream_client(proxy)
+            self.stream_proxy = proxy
+    
+    def set_image_base_url(self, url: Optional[str]):
+        """设置图片基础URL，只在配置变化时规范化一次"""
+        url = (url or "").strip()
+        # 确保以 / 结尾
+        if url and not url.endswith("/"):
+            url += "/"
+        self.image_base_url = url
     
     def load_config(self):
         """加载配置"""
@@ -66,20 +181,68 @@ class AccountManager:
                 self.accounts = self.config.get("accounts", [])
                 # 初始化账号状态
                 for i, acc in enumerate(self.accounts):
-                    available = acc.get("available", True)  # 默认可用
-                    self.account_states[i] = {
-                        "jwt": None,
-                        "jwt_time": 0,
-                        "session": None,
-                        "available": available
-                    }
+                    self.account_states[i] = self.create_account_state(acc)
+            self.set_proxy(self.config.get("proxy"))
+            self.set_image_base_url(self.config.get("image_base_url"))
+            self.models_response = None
+            self.refresh_available_accounts()
         return self.config
     
+    @staticmethod
+    def create_account_state(account: dict) -> dict:
+        """创建账号的运行时状态，恢复配置文件中缓存的JWT"""
+        cached = account.get("cached_jwt") or {}
+        return {
+            "jwt": cached.get("jwt"),
+            "jwt_time": cached.get("jwt_time", 0),
+            "jwt_exp": cached.get("exp", 0),
+            "jwt_lock": threading.Lock(),  # 每个账号独立的JWT刷新锁
+            "session": None,
+            "available": account.get("available", True)  # 默认可用
+        }
+    
     def save_config(self):
-        """保存配置到文件"""
+        """保存配置到文件（调用方需持有 self.lock）
+        
+        先完整序列化再写入临时文件并替换，序列化或写入失败都不会留下截断的配置文件
+        """
         if self.config and CONFIG_FILE.exists():
-            with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-                json.dump(self.config, f, indent=4, ensure_ascii=False)
+            data = json.dumps(self.config, indent=4, ensure_ascii=False)
+            tmp_file = CONFIG_FILE.with_name(f"{CONFIG_FILE.name}.tmp")
+            tmp_file.write_text(data, encoding="utf-8")
+            os.replace(tmp_file, CONFIG_FILE)
+    
+    def schedule_flush(self):
+        """CONFIG_SAVE_DELAY 秒后写盘（调用方需持有 save_lock）"""
+        if self.save_timer is None:
+            self.save_timer = threading.Timer(CONFIG_SAVE_DELAY, self.flush_config)
+            self.save_timer.daemon = True
+            self.save_timer.start()
+    
+    def mark_dirty(self):
+        """标记配置已修改，延迟 CONFIG_SAVE_DELAY 秒后统一写盘"""
+        self.models_response = None
+        with self.save_lock:
+            self.dirty = True
+            self.schedule_flush()
+    
+    def flush_config(self):
+        """立即写入尚未保存的配置修改"""
+        # 加锁顺序与 mark_account_unavailable 中一致: 先 self.lock 再 save_lock
+        with self.lock, self.save_lock:
+            if self.save_timer is not None:
+                self.save_timer.cancel()
+                self.save_timer = None
+            if not self.dirty:
+                return
+            self.dirty = False
+            try:
+                self.save_config()
+            except Exception as e:
+                # 例如序列化期间配置被其他线程修改，稍后重试
+                self.dirty = True
+                self.schedule_flush()
+                logger.warning("[配置] 保存失败，稍后重试: %s", e)
     
     def mark_account_unavailable(self, index: int, reason: str = ""):
         """标记账号不可用"""
@@ -89,26 +252,50 @@ class AccountManager:
                 self.accounts[index]["unavailable_reason"] = reason
                 self.accounts[index]["unavailable_time"] = datetime.now().isoformat()
                 self.account_states[index]["available"] = False
-                self.save_config()
+                self.rebuild_available_snapshot()
+                self.mark_dirty()
                 print(f"[!] 账号 {index} 已标记为不可用: {reason}")
     
+    def rebuild_available_snapshot(self):
+        """重建可用账号快照（调用方需持有 self.lock）"""
+        self.available_snapshot = tuple(
+            (i, acc) for i, acc in enumerate(self.accounts)
+            if self.account_states.get(i, {}).get("available", True))
+    
+    def refresh_available_accounts(self):
+        """账号列表或可用状态变化后刷新可用账号快照"""
+        with self.lock:
+            self.rebuild_available_snapshot()
+    
     def get_available_accounts(self):
-        """获取可用账号列表"""
-        return [(i, acc) for i, acc in enumerate(self.accounts) 
-                if self.account_states.get(i, {}).get("available", True)]
+        """获取可用账号列表（只读快照，读取无需加锁）"""
+        return self.available_snapshot
     
     def get_next_account(self):
-        """轮训获取下一个可用账号"""
-        with self.lock:
-            available = self.get_available_accounts()
-            if not available:
-                raise Exception("没有可用的账号")
-            
-            # 轮训选择
-            self.current_index = self.current_index % len(available)
-            idx, account = available[self.current_index]
-            self.current_index = (self.current_index + 1) % len(available)
-            return idx, account
+        """轮训获取下一个可用账号（无锁）"""
+        available = self.available_snapshot
+        if not available:
+            raise Exception("没有可用的账号")
+        
+        # 轮训选择
+        return available[next(self.round_robin) % len(available)]
+    
+    def warm_jwts(self, min_ttl: float = JWT_WARM_TTL):
+        """并发预刷新所有可用账号中即将过期的JWT"""
+        items = self.get_available_accounts()
+        if not items:
+            return
+        
+        def refresh(item):
+            try:
+                # 后台预热失败只记录日志，账号留到真正处理请求时再判断是否不可用，
+                # 避免一次网络或代理抖动把所有账号都标记为不可用
+                ensure_jwt_for_account(*item, min_ttl=min_ttl, mark_unavailable=False)
+            except Exception as e:
+                logger.debug("[JWT预热] 账号 %s 刷新失败: %s", item[0], e)  # 失败原因已在 ensure_jwt_for_account 中记录
+        
+        with ThreadPoolExecutor(max_workers=min(JWT_WARM_WORKERS, len(items))) as executor:
+            list(executor.map(refresh, items))
     
     def get_account_count(self):
         """获取账号数量统计"""
@@ -153,6 +340,17 @@ class FileManager:
         file_info = self.files.get(openai_file_id)
         return file_info.get("gemini_file_id") if file_info else None
     
+    def get_gemini_file_ids(self, openai_file_ids: List[str]) -> List[str]:
+        """批量获取 Gemini 文件ID，跳过没有映射的文件"""
+        gemini_file_ids = []
+        for fid in openai_file_ids:
+            file_info = self.files.get(fid)
+            if file_info:
+                gemini_file_ids.append(file_info["gemini_file_id"])
+            else:
+                logger.warning("[文件] 未找到文件映射: %s", fid)
+        return gemini_file_ids
+    
     def delete_file(self, openai_file_id: str) -> bool:
         """删除文件映射"""
         if openai_file_id in self.files:
@@ -187,22 +385,52 @@ def check_proxy(proxy: str) -> bool:
         return False
 
 
+# 代理检测结果缓存: proxy -> (检测时间, 是否可用)
+PROXY_CHECK_CACHE: Dict[str, tuple] = {}
+
+
+def cached_check_proxy(proxy: str, ttl: float = PROXY_CHECK_TTL) -> bool:
+    """带缓存的代理检测，ttl秒内重复查询直接返回上次结果，避免状态轮询反复探测代理"""
+    if not proxy:
+        return False
+    now = time.time()
+    cached = PROXY_CHECK_CACHE.get(proxy)
+    if cached and now - cached[0] < ttl:
+        return cached[1]
+    available = check_proxy(proxy)
+    PROXY_CHECK_CACHE[proxy] = (time.time(), available)
+    return available
+
+
 def url_safe_b64encode(data: bytes) -> str:
     """URL安全的Base64编码，不带padding"""
     return base64.urlsafe_b64encode(data).decode('utf-8').rstrip('=')
 
 
 def kq_encode(s: str) -> str:
-    """模拟JS的kQ函数"""
-    byte_arr = bytearray()
-    for char in s:
-        val = ord(char)
-        if val > 255:
-            byte_arr.append(val & 255)
-            byte_arr.append(val >> 8)
-        else:
-            byte_arr.append(val)
-    return url_safe_b64encode(bytes(byte_arr))
+    """模拟JS的kQ函数
+    
+    码点不超过255的字符输出单字节，其余字符按UTF-16小端序输出两个字节
+    """
+    try:
+        # 常见情况：全部为单字节字符，直接走C实现的latin-1编码
+        data = s.encode('latin-1')
+    except UnicodeEncodeError:
+        data = WIDE_CHAR_RE.sub(lambda m: m.group().encode('utf-16-le').decode('latin-1'), s).encode('latin-1')
+    return url_safe_b64encode(data)
+
+
+def encode_jwt_segment(obj: dict) -> str:
+    """序列化JWT的header/payload并进行kQ编码
+    
+    输出与 kq_encode(json.dumps(obj, separators=(',', ':'))) 一致。orjson 输出纯ASCII时
+    两者的JSON相同，kQ编码等价于直接base64；含非ASCII字符时 json.dumps 会转义为 \\uXXXX，
+    而 orjson 直接输出UTF-8，此时退回 json.dumps 以保持相同的token。
+    """
+    data = orjson.dumps(obj)
+    if data.isascii():
+        return url_safe_b64encode(data)
+    return kq_encode(json.dumps(obj, separators=(',', ':')))
 
 
 def decode_xsrf_token(xsrf_token: str) -> bytes:
@@ -232,17 +460,24 @@ def create_jwt(key_bytes: bytes, key_id: str, csesidx: str) -> str:
         "nbf": now
     }
 
-    header_b64 = kq_encode(json.dumps(header, separators=(',', ':')))
-    payload_b64 = kq_encode(json.dumps(payload, separators=(',', ':')))
+    header_b64 = encode_jwt_segment(header)
+    payload_b64 = encode_jwt_segment(payload)
     message = f"{header_b64}.{payload_b64}"
 
-    signature = hmac.new(key_bytes, message.encode('utf-8'), hashlib.sha256).digest()
+    signature = hmac.new(key_bytes, message.encode('ascii'), hashlib.sha256).digest()
     signature_b64 = url_safe_b64encode(signature)
 
     return f"{message}.{signature_b64}"
 
 
-def get_jwt_for_account(account: dict, proxy: str) -> str:
+def get_jwt_exp(jwt: str) -> int:
+    """从JWT的payload中解析过期时间（exp）"""
+    payload_b64 = jwt.split(".")[1]
+    payload = base64.urlsafe_b64decode(payload_b64 + "=" * (-len(payload_b64) % 4))
+    return int(orjson.loads(payload)["exp"])
+
+
+def get_jwt_for_account(account: dict) -> str:
     """为指定账号获取JWT"""
     secure_c_ses = account.get("secure_c_ses")
     host_c_oses = account.get("host_c_oses")
@@ -252,7 +487,6 @@ def get_jwt_for_account(account: dict, proxy: str) -> str:
         raise ValueError("缺少 secure_c_ses 或 csesidx")
 
     url = f"{GETOXSRF_URL}?csesidx={csesidx}"
-    proxies = {"http": proxy, "https": proxy} if proxy else None
 
     headers = {
         "accept": "*/*",
@@ -260,14 +494,14 @@ def get_jwt_for_account(account: dict, proxy: str) -> str:
         "cookie": f'__Secure-C_SES={secure_c_ses}; __Host-C_OSES={host_c_oses}',
     }
 
-    resp = requests.get(url, headers=headers, proxies=proxies, verify=False, timeout=30)
+    resp = account_manager.http.get(url, headers=headers, verify=False, timeout=30)
 
     # 处理Google安全前缀
     text = resp.text
     if text.startswith(")]}'\n") or text.startswith(")]}'"): 
         text = text[4:].strip()
 
-    data = json.loads(text)
+    data = orjson.loads(text)
     key_id = data["keyId"]
     print(f"账号: {account.get('csesidx')} 账号可用! key_id: {key_id}")
     xsrf_token = data["xsrfToken"]
@@ -277,54 +511,61 @@ def get_jwt_for_account(account: dict, proxy: str) -> str:
     return create_jwt(key_bytes, key_id, csesidx)
 
 
-def get_headers(jwt: str) -> dict:
-    """获取请求头"""
-    return {
-        "accept": "*/*",
-        "accept-encoding": "gzip, deflate, br, zstd",
-        "accept-language": "zh-CN,zh;q=0.9,en;q=0.8",
-        "authorization": f"Bearer {jwt}",
-        "content-type": "application/json",
-        "origin": "https://business.gemini.google",
-        "referer": "https://business.gemini.google/",
-        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36",
-        "x-server-timeout": "1800",
-    }
+@functools.lru_cache(maxsize=128)
+def get_headers(jwt: str) -> Mapping[str, str]:
+    """获取请求头（按JWT缓存，JWT轮换前重复使用同一个只读对象）"""
+    return MappingProxyType({**BASE_HEADERS, "authorization": f"Bearer {jwt}"})
 
 
-def ensure_jwt_for_account(account_idx: int, account: dict):
-    """确保指定账号的JWT有效，必要时刷新"""
-    print(f"[DEBUG][ensure_jwt_for_account] 开始 - 账号索引: {account_idx}, CSESIDX: {account.get('csesidx')}")
+def ensure_jwt_for_account(account_idx: int, account: dict, min_ttl: float = JWT_REFRESH_MARGIN,
+                           mark_unavailable: bool = True):
+    """确保指定账号的JWT有效，剩余有效期不足 min_ttl 秒时刷新
+    
+    mark_unavailable 为 False 时刷新失败只抛出异常，不标记账号不可用
+    """
+    logger.debug("[ensure_jwt_for_account] 开始 - 账号索引: %s, CSESIDX: %s", account_idx, account.get('csesidx'))
     start_time = time.time()
-    with account_manager.lock:
-        state = account_manager.account_states[account_idx]
-        jwt_age = time.time() - state["jwt_time"] if state["jwt"] else float('inf')
-        print(f"[DEBUG][ensure_jwt_for_account] JWT状态 - 存在: {state['jwt'] is not None}, 年龄: {jwt_age:.2f}秒")
-        if state["jwt"] is None or jwt_age > 240:
-            print(f"[DEBUG][ensure_jwt_for_account] 需要刷新JWT...")
-            proxy = account_manager.config.get("proxy")
+    state = account_manager.account_states[account_idx]
+    # 按账号加锁，刷新一个账号的JWT时不阻塞其他账号
+    with state["jwt_lock"]:
+        jwt_ttl = state["jwt_exp"] - time.time() if state["jwt"] else float('-inf')
+        logger.debug("[ensure_jwt_for_account] JWT状态 - 存在: %s, 剩余有效期: %.2f秒", state['jwt'] is not None, jwt_ttl)
+        if state["jwt"] is None or jwt_ttl <= min_ttl:
+            logger.debug("[ensure_jwt_for_account] 需要刷新JWT...")
             try:
                 refresh_start = time.time()
-                state["jwt"] = get_jwt_for_account(account, proxy)
+                jwt = get_jwt_for_account(account)
+                state["jwt"] = jwt
                 state["jwt_time"] = time.time()
-                print(f"[DEBUG][ensure_jwt_for_account] JWT刷新成功 - 耗时: {time.time() - refresh_start:.2f}秒")
+                state["jwt_exp"] = get_jwt_exp(jwt)
+                logger.debug("[ensure_jwt_for_account] JWT刷新成功 - 耗时: %.2f秒", time.time() - refresh_start)
             except Exception as e:
-                print(f"[DEBUG][ensure_jwt_for_account] JWT刷新失败: {e}")
+                logger.warning("[ensure_jwt_for_account] JWT刷新失败: %s", e)
                 # JWT获取失败，标记账号不可用
-                account_manager.mark_account_unavailable(account_idx, str(e))
+                if mark_unavailable:
+                    account_manager.mark_account_unavailable(account_idx, str(e))
                 raise
+            # 持久化JWT，重启后在有效期内无需重新获取
+            # 与 flush_config 序列化配置使用同一把锁，避免写盘时字典被修改
+            with account_manager.lock:
+                account["cached_jwt"] = {
+                    "jwt": state["jwt"],
+                    "jwt_time": state["jwt_time"],
+                    "exp": state["jwt_exp"]
+                }
+            account_manager.mark_dirty()
         else:
-            print(f"[DEBUG][ensure_jwt_for_account] 使用缓存JWT")
-        print(f"[DEBUG][ensure_jwt_for_account] 完成 - 总耗时: {time.time() - start_time:.2f}秒")
+            logger.debug("[ensure_jwt_for_account] 使用缓存JWT")
+        logger.debug("[ensure_jwt_for_account] 完成 - 总耗时: %.2f秒", time.time() - start_time)
         return state["jwt"]
 
 
-def create_chat_session(jwt: str, team_id: str, proxy: str) -> str:
+def create_chat_session(jwt: str, team_id: str) -> str:
     """创建会话，返回session ID"""
-    print(f"[DEBUG][create_chat_session] 开始 - team_id: {team_id}")
+    logger.debug("[create_chat_session] 开始 - team_id: %s", team_id)
     start_time = time.time()
-    session_id = uuid.uuid4().hex[:12]
-    print(f"[DEBUG][create_chat_session] 生成session_id: {session_id}")
+    session_id = secrets.token_hex(6)
+    logger.debug("[create_chat_session] 生成session_id: %s", session_id)
     body = {
         "configId": team_id,
         "additionalParams": {"token": "-"},
@@ -333,64 +574,112 @@ def create_chat_session(jwt: str, team_id: str, proxy: str) -> str:
         }
     }
 
-    proxies = {"http": proxy, "https": proxy} if proxy else None
-    print(f"[DEBUG][create_chat_session] 发送请求到: {CREATE_SESSION_URL}")
-    print(f"[DEBUG][create_chat_session] 使用代理: {proxy}")
+    logger.debug("[create_chat_session] 发送请求到: %s", CREATE_SESSION_URL)
     
     request_start = time.time()
-    resp = requests.post(
+    resp = account_manager.http.post(
         CREATE_SESSION_URL,
         headers=get_headers(jwt),
-        json=body,
-        proxies=proxies,
+        data=orjson.dumps(body),
         verify=False,
         timeout=30
     )
-    print(f"[DEBUG][create_chat_session] 请求完成 - 状态码: {resp.status_code}, 耗时: {time.time() - request_start:.2f}秒")
+    logger.debug("[create_chat_session] 请求完成 - 状态码: %s, 耗时: %.2f秒", resp.status_code, time.time() - request_start)
 
     if resp.status_code != 200:
-        print(f"[DEBUG][create_chat_session] 请求失败 - 响应: {resp.text[:500]}")
+        logger.warning("[create_chat_session] 请求失败 - 响应: %s", resp.text[:500])
         if resp.status_code == 401:
-            print(f"[DEBUG][create_chat_session] 401错误 - 可能是team_id填错了")
+            logger.warning("[create_chat_session] 401错误 - 可能是team_id填错了")
         raise Exception(f"创建会话失败: {resp.status_code}")
 
-    data = resp.json()
+    data = orjson.loads(resp.content)
     session_name = data.get("session", {}).get("name")
-    print(f"[DEBUG][create_chat_session] 完成 - session_name: {session_name}, 总耗时: {time.time() - start_time:.2f}秒")
+    logger.debug("[create_chat_session] 完成 - session_name: %s, 总耗时: %.2f秒", session_name, time.time() - start_time)
     return session_name
 
 
 def ensure_session_for_account(account_idx: int, account: dict):
     """确保指定账号的会话有效"""
-    print(f"[DEBUG][ensure_session_for_account] 开始 - 账号索引: {account_idx}")
+    logger.debug("[ensure_session_for_account] 开始 - 账号索引: %s", account_idx)
     start_time = time.time()
     
     jwt_start = time.time()
     jwt = ensure_jwt_for_account(account_idx, account)
-    print(f"[DEBUG][ensure_session_for_account] JWT获取完成 - 耗时: {time.time() - jwt_start:.2f}秒")
+    logger.debug("[ensure_session_for_account] JWT获取完成 - 耗时: %.2f秒", time.time() - jwt_start)
     
     with account_manager.lock:
         state = account_manager.account_states[account_idx]
-        print(f"[DEBUG][ensure_session_for_account] 当前session状态: {state['session'] is not None}")
+        logger.debug("[ensure_session_for_account] 当前session状态: %s", state['session'] is not None)
         if state["session"] is None:
-            print(f"[DEBUG][ensure_session_for_account] 需要创建新session...")
-            proxy = account_manager.config.get("proxy")
+            logger.debug("[ensure_session_for_account] 需要创建新session...")
             team_id = account.get("team_id")
             session_start = time.time()
-            state["session"] = create_chat_session(jwt, team_id, proxy)
-            print(f"[DEBUG][ensure_session_for_account] Session创建完成 - 耗时: {time.time() - session_start:.2f}秒")
+            state["session"] = create_chat_session(jwt, team_id)
+            logger.debug("[ensure_session_for_account] Session创建完成 - 耗时: %.2f秒", time.time() - session_start)
         else:
-            print(f"[DEBUG][ensure_session_for_account] 使用缓存session: {state['session']}")
+            logger.debug("[ensure_session_for_account] 使用缓存session: %s", state['session'])
         
-        print(f"[DEBUG][ensure_session_for_account] 完成 - 总耗时: {time.time() - start_time:.2f}秒")
+        logger.debug("[ensure_session_for_account] 完成 - 总耗时: %.2f秒", time.time() - start_time)
         return state["session"], jwt, account.get("team_id")
 
 
 # ==================== 文件上传功能 ====================
 
+def split_upload_body(body: dict) -> tuple[bytes, bytes]:
+    """序列化上传请求，返回 fileContents 字符串值前后的两部分（不含引号）"""
+    placeholder = "__FILE_CONTENTS__"
+    body["addContextFileRequest"]["fileContents"] = placeholder
+    head, tail = orjson.dumps(body).split(f'"{placeholder}"'.encode(), 1)
+    return head, tail
+
+
+def iter_upload_body(body: dict, file_obj: BinaryIO) -> Iterator[bytes]:
+    """分块生成文件上传请求的JSON
+    
+    从 file_obj 当前位置逐块读取并进行base64编码后输出，内存中不会同时存在
+    完整的文件内容、base64字符串和序列化后的JSON，输出内容与 orjson.dumps(body) 一致。
+    """
+    head, tail = split_upload_body(body)
+    
+    yield head + b'"'
+    pending = b""  # 不足3字节倍数的剩余部分，留到下一块一起编码
+    while True:
+        chunk = file_obj.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        if pending:
+            chunk = pending + chunk
+        cut = len(chunk) - len(chunk) % 3
+        pending = chunk[cut:]
+        yield base64.b64encode(memoryview(chunk)[:cut])
+    if pending:
+        yield base64.b64encode(pending)
+    yield b'"' + tail
+
+
+class UploadBody:
+    """文件上传请求体
+    
+    可迭代，逐块输出 iter_upload_body 的内容；同时提供总长度，
+    requests 据此发送 Content-Length，而不是使用分块传输编码。
+    """
+    
+    def __init__(self, body: dict, file_obj: BinaryIO, file_size: int):
+        self.body = body
+        self.file_obj = file_obj
+        head, tail = split_upload_body(body)
+        # 两个引号 + base64编码后的长度（每3字节输出4字节，末尾补齐）
+        self.length = len(head) + 2 + 4 * ((file_size + 2) // 3) + len(tail)
+    
+    def __len__(self) -> int:
+        return self.length
+    
+    def __iter__(self) -> Iterator[bytes]:
+        return iter_upload_body(self.body, self.file_obj)
+
+
 def upload_file_to_gemini(jwt: str, session_name: str, team_id: str, 
-                          file_content: bytes, filename: str, mime_type: str,
-                          proxy: str = None) -> str:
+                          file_obj: BinaryIO, file_size: int, filename: str, mime_type: str) -> str:
     """
     上传文件到 Gemini，返回 Gemini 的 fileId
     
@@ -398,24 +687,20 @@ def upload_file_to_gemini(jwt: str, session_name: str, team_id: str,
         jwt: JWT 认证令牌
         session_name: 会话名称
         team_id: 团队ID
-        file_content: 文件内容（字节）
+        file_obj: 文件对象，从当前位置流式读取
+        file_size: 文件大小（字节）
         filename: 文件名
         mime_type: MIME 类型
-        proxy: 代理地址
     
     Returns:
         str: Gemini 返回的 fileId
     """
     start_time = time.time()
-    print(f"[DEBUG][upload_file_to_gemini] 开始上传文件: {filename}, MIME类型: {mime_type}, 文件大小: {len(file_content)} bytes")
-    
-    encode_start = time.time()
-    file_contents_b64 = base64.b64encode(file_content).decode('utf-8')
-    print(f"[DEBUG][upload_file_to_gemini] Base64编码完成 - 耗时: {time.time() - encode_start:.2f}秒, 编码后大小: {len(file_contents_b64)} chars")
+    logger.debug("[upload_file_to_gemini] 开始上传文件: %s, MIME类型: %s, 文件大小: %s bytes", filename, mime_type, file_size)
     
     body = {
         "addContextFileRequest": {
-            "fileContents": file_contents_b64,
+            "fileContents": None,  # 由 iter_upload_body 分块填充
             "fileName": filename,
             "mimeType": mime_type,
             "name": session_name
@@ -424,35 +709,32 @@ def upload_file_to_gemini(jwt: str, session_name: str, team_id: str,
         "configId": team_id
     }
     
-    proxies = {"http": proxy, "https": proxy} if proxy else None
-    print(f"[DEBUG][upload_file_to_gemini] 准备发送请求到: {ADD_CONTEXT_FILE_URL}")
-    print(f"[DEBUG][upload_file_to_gemini] 使用代理: {proxy if proxy else '无'}")
+    logger.debug("[upload_file_to_gemini] 准备发送请求到: %s", ADD_CONTEXT_FILE_URL)
     
     request_start = time.time()
-    resp = requests.post(
+    resp = account_manager.http.post(
         ADD_CONTEXT_FILE_URL,
         headers=get_headers(jwt),
-        json=body,
-        proxies=proxies,
+        data=UploadBody(body, file_obj, file_size),
         verify=False,
         timeout=60
     )
-    print(f"[DEBUG][upload_file_to_gemini] 请求完成 - 耗时: {time.time() - request_start:.2f}秒, 状态码: {resp.status_code}")
+    logger.debug("[upload_file_to_gemini] 请求完成 - 耗时: %.2f秒, 状态码: %s", time.time() - request_start, resp.status_code)
     
     if resp.status_code != 200:
-        print(f"[DEBUG][upload_file_to_gemini] 上传失败 - 响应内容: {resp.text[:500]}")
+        logger.warning("[upload_file_to_gemini] 上传失败 - 响应内容: %s", resp.text[:500])
         raise Exception(f"文件上传失败: {resp.status_code} - {resp.text}")
     
     parse_start = time.time()
-    data = resp.json()
+    data = orjson.loads(resp.content)
     file_id = data.get("addContextFileResponse", {}).get("fileId")
-    print(f"[DEBUG][upload_file_to_gemini] 解析响应完成 - 耗时: {time.time() - parse_start:.2f}秒")
+    logger.debug("[upload_file_to_gemini] 解析响应完成 - 耗时: %.2f秒", time.time() - parse_start)
     
     if not file_id:
-        print(f"[DEBUG][upload_file_to_gemini] 响应中未找到fileId - 响应数据: {data}")
+        logger.warning("[upload_file_to_gemini] 响应中未找到fileId - 响应数据: %s", data)
         raise ValueError(f"响应中未找到 fileId: {data}")
     
-    print(f"[DEBUG][upload_file_to_gemini] 上传成功 - fileId: {file_id}, 总耗时: {time.time() - start_time:.2f}秒")
+    logger.debug("[upload_file_to_gemini] 上传成功 - fileId: %s, 总耗时: %.2f秒", file_id, time.time() - start_time)
     return file_id
 
 
@@ -462,11 +744,18 @@ def upload_file_to_gemini(jwt: str, session_name: str, team_id: str,
 class ChatImage:
     """表示生成的图片"""
     url: Optional[str] = None
-    base64_data: Optional[str] = None
     mime_type: str = "image/png"
     local_path: Optional[str] = None
     file_id: Optional[str] = None
     file_name: Optional[str] = None
+    
+    @property
+    def base64_data(self) -> Optional[str]:
+        """按需从缓存文件读取base64数据，不在内存中常驻"""
+        if not self.local_path:
+            return None
+        with open(self.local_path, "rb") as f:
+            return base64.b64encode(f.read()).decode("ascii")
 
 
 @dataclass
@@ -479,64 +768,66 @@ class ChatResponse:
 
 def cleanup_expired_images():
     """清理过期的缓存图片"""
-    if not IMAGE_CACHE_DIR.exists():
-        return
+    # 缓存目录被外部删除时在此重建，保存图片时不再逐次检查
+    IMAGE_CACHE_DIR.mkdir(exist_ok=True)
     
     now = time.time()
     max_age_seconds = IMAGE_CACHE_HOURS * 3600
     
-    for filepath in IMAGE_CACHE_DIR.iterdir():
-        if filepath.is_file():
+    # scandir 在读取目录时即带回文件类型和stat信息，无需逐个文件再调用stat
+    with os.scandir(IMAGE_CACHE_DIR) as entries:
+        for entry in entries:
             try:
-                file_age = now - filepath.stat().st_mtime
-                if file_age > max_age_seconds:
-                    filepath.unlink()
-                    print(f"[图片缓存] 已删除过期图片: {filepath.name}")
-            except Exception as e:
-                print(f"[图片缓存] 删除失败: {filepath.name}, 错误: {e}")
+                if entry.is_file() and now - entry.stat().st_mtime > max_age_seconds:
+                    os.unlink(entry.path)
+                    print(f"[图片缓存] 已删除过期图片: {entry.name}")
+            except FileNotFoundError:
+                pass  # 已被其他线程删除
 
 
 def save_image_to_cache(image_data: bytes, mime_type: str = "image/png", filename: Optional[str] = None) -> str:
     """保存图片到缓存目录，返回文件名"""
-    IMAGE_CACHE_DIR.mkdir(exist_ok=True)
-    
     # 确定文件扩展名
-    ext_map = {
-        "image/png": ".png",
-        "image/jpeg": ".jpg",
-        "image/gif": ".gif",
-        "image/webp": ".webp",
-    }
-    ext = ext_map.get(mime_type, ".png")
+    ext = IMAGE_EXT_MAP.get(mime_type, ".png")
     
     if filename:
         # 确保有正确的扩展名
-        if not any(filename.endswith(e) for e in ext_map.values()):
+        if not filename.endswith(IMAGE_EXTS):
             filename = f"{filename}{ext}"
     else:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"gemini_{timestamp}_{uuid.uuid4().hex[:8]}{ext}"
+        filename = f"gemini_{timestamp}_{secrets.token_hex(4)}{ext}"
     
-    filepath = IMAGE_CACHE_DIR / filename
-    with open(filepath, "wb") as f:
-        f.write(image_data)
+    # 单次整块写入，直接使用文件描述符，跳过缓冲IO层
+    fd = os.open(IMAGE_CACHE_DIR / filename, IMAGE_OPEN_FLAGS, 0o644)
+    try:
+        view = memoryview(image_data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+    
+    # 保存时计算一次内容哈希作为ETag，提供图片时无需再读取文件计算
+    etag_path = IMAGE_CACHE_DIR / f"{filename}{IMAGE_ETAG_SUFFIX}"
+    etag_path.write_text(hashlib.sha256(image_data).hexdigest(), encoding="ascii")
     
     return filename
 
 
-def extract_images_from_openai_content(content: Any) -> tuple[str, List[Dict]]:
-    """从OpenAI格式的content中提取文本和图片
+def extract_images_from_openai_content(content: Any) -> tuple[str, List[Dict], List[str]]:
+    """从OpenAI格式的content中提取文本、图片和文件ID
     
-    返回: (文本内容, 图片列表[{type: 'base64'|'url', data: ...}])
+    返回: (文本内容, 图片列表[{type: 'base64'|'url', data: ...}], OpenAI file_id列表)
     """
     if isinstance(content, str):
-        return content, []
+        return content, [], []
     
     if not isinstance(content, list):
-        return str(content), []
+        return str(content), [], []
     
     text_parts = []
     images = []
+    file_ids = []
     
     for item in content:
         if not isinstance(item, dict):
@@ -556,13 +847,11 @@ def extract_images_from_openai_content(content: Any) -> tuple[str, List[Dict]]:
             
             if url.startswith("data:"):
                 # base64格式: data:image/png;base64,xxxxx
-                match = re.match(r"data:([^;]+);base64,(.+)", url)
-                if match:
-                    mime_type = match.group(1)
-                    base64_data = match.group(2)
+                header, _, base64_data = url[5:].partition(";base64,")
+                if header and base64_data:
                     images.append({
                         "type": "base64",
-                        "mime_type": mime_type,
+                        "mime_type": header.split(";", 1)[0],
                         "data": base64_data
                     })
             else:
@@ -571,14 +860,22 @@ def extract_images_from_openai_content(content: Any) -> tuple[str, List[Dict]]:
                     "type": "url",
                     "url": url
                 })
+        
+        elif item_type == "file":
+            # 格式1: {"type": "file", "file_id": "xxx"}
+            # 格式2: {"type": "file", "file": {"file_id": "xxx"}}，也支持 id 字段名
+            fid = item.get("file_id")
+            if not fid and isinstance(item.get("file"), dict):
+                fid = item["file"].get("file_id") or item["file"].get("id")
+            if fid:
+                file_ids.append(fid)
     
-    return "\n".join(text_parts), images
+    return "\n".join(text_parts), images, file_ids
 
 
-def download_image_from_url(url: str, proxy: Optional[str] = None) -> tuple[bytes, str]:
+def download_image_from_url(url: str) -> tuple[bytes, str]:
     """从URL下载图片，返回(图片数据, mime_type)"""
-    proxies = {"http": proxy, "https": proxy} if proxy else None
-    resp = requests.get(url, proxies=proxies, verify=False, timeout=60)
+    resp = account_manager.http.get(url, verify=False, timeout=60)
     resp.raise_for_status()
     
     content_type = resp.headers.get("Content-Type", "image/png")
@@ -588,7 +885,7 @@ def download_image_from_url(url: str, proxy: Optional[str] = None) -> tuple[byte
     return resp.content, mime_type
 
 
-def get_session_file_metadata(jwt: str, session_name: str, team_id: str, proxy: Optional[str] = None) -> Dict:
+def get_session_file_metadata(jwt: str, session_name: str, team_id: str) -> Dict:
     """获取会话中的文件元数据（AI生成的图片）"""
     body = {
         "configId": team_id,
@@ -599,12 +896,10 @@ def get_session_file_metadata(jwt: str, session_name: str, team_id: str, proxy:
         }
     }
     
-    proxies = {"http": proxy, "https": proxy} if proxy else None
-    resp = requests.post(
+    resp = account_manager.http.post(
         LIST_FILE_METADATA_URL,
         headers=get_headers(jwt),
-        json=body,
-        proxies=proxies,
+        data=orjson.dumps(body),
         verify=False,
         timeout=30
     )
@@ -613,7 +908,7 @@ def get_session_file_metadata(jwt: str, session_name: str, team_id: str, proxy:
         print(f"[图片] 获取文件元数据失败: {resp.status_code}")
         return {}
     
-    data = resp.json()
+    data = orjson.loads(resp.content)
     # 返回 fileId -> metadata 的映射
     result = {}
     file_metadata_list = data.get("listSessionFileMetadataResponse", {}).get("fileMetadata", [])
@@ -629,15 +924,13 @@ def build_download_url(session_name: str, file_id: str) -> str:
     return f"https://biz-discoveryengine.googleapis.com/v1alpha/{session_name}:downloadFile?fileId={file_id}&alt=media"
 
 
-def download_file_with_jwt(jwt: str, session_name: str, file_id: str, proxy: Optional[str] = None) -> bytes:
+def download_file_with_jwt(jwt: str, session_name: str, file_id: str) -> bytes:
     """使用JWT认证下载文件"""
     url = build_download_url(session_name, file_id)
-    proxies = {"http": proxy, "https": proxy} if proxy else None
     
-    resp = requests.get(
+    resp = account_manager.http.get(
         url,
         headers=get_headers(jwt),
-        proxies=proxies,
         verify=False,
         timeout=120,
         allow_redirects=True
@@ -646,38 +939,114 @@ def download_file_with_jwt(jwt: str, session_name: str, file_id: str, proxy: Opt
     resp.raise_for_status()
     content = resp.content
     
-    # 检测是否为base64编码的内容
-    try:
-        text_content = content.decode("utf-8", errors="ignore").strip()
-        if text_content.startswith("iVBORw0KGgo") or text_content.startswith("/9j/"):
-            # 是base64编码，需要解码
-            return base64.b64decode(text_content)
-    except Exception:
-        pass
+    # 检测是否为base64编码的内容（只检查开头，避免解码整个文件）
+    head = content[:16].lstrip()
+    if head.startswith(b"iVBORw0KGgo") or head.startswith(b"/9j/"):
+        # 是base64编码，需要解码
+        try:
+            return decode_image_base64(content)
+        except Exception:
+            pass
     
     return content
 
 
+def iter_byte_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    """把字节流按 \\n 切分成行并解码
+    
+    不能使用 httpx 的 iter_lines()：它按 str.splitlines() 切分，会在 U+2028、U+0085
+    等字符处断行，而这些字符可以不经转义出现在JSON字符串中。
+    按字节切分不会拆开UTF-8多字节字符。
+    """
+    pending = []  # 当前行已收到但尚未遇到换行的片段
+    for chunk in chunks:
+        # 只在新收到的块里查找换行，行结束时才拼接，超长的单行（如base64图片）也是线性时间
+        start = 0
+        end = chunk.find(b"\n")
+        while end != -1:
+            if pending:
+                pending.append(chunk[start:end])
+                line = b"".join(pending)
+                pending = []
+            else:
+                line = chunk[start:end]
+            yield line.rstrip(b"\r").decode("utf-8")
+            start = end + 1
+            end = chunk.find(b"\n", start)
+        if start < len(chunk):
+            pending.append(chunk[start:])
+    if pending:
+        yield b"".join(pending).rstrip(b"\r").decode("utf-8")
+
+
+def iter_json_array(lines: Iterable[str]) -> Iterator[Any]:
+    """增量解析按行返回的JSON数组，每收到一个完整元素立即产出
+    
+    JSON字符串内不能包含换行，因此逐行扫描括号深度即可定位元素边界，
+    无需把整个响应拼接成一个字符串后再解析。
+    """
+    depth = 0
+    parts = []  # 当前元素已接收的文本片段
+    for text in lines:
+        if not text:
+            continue
+        start = 0 if depth > 1 else None
+        for match in JSON_TOKEN_RE.finditer(text):
+            token = match.group()
+            if token[0] in "{[":
+                depth += 1
+                if depth == 2:
+                    start = match.start()
+            elif token[0] in "}]":
+                depth -= 1
+                if depth == 1:
+                    parts.append(text[start:match.end()])
+                    yield orjson.loads("".join(parts))
+                    parts = []
+                    start = None
+        if start is not None:
+            parts.append(text[start:] + "\n")
+
+
 def stream_chat_with_images(jwt: str, sess_name: str, message: str, images: List[Dict], 
-                            proxy: str, team_id: str, file_ids: List[str] = None) -> ChatResponse:
-    """发送消息并流式接收响应，支持图片输入输出和文件附件
+                            team_id: str, file_ids: List[str] = None) -> ChatResponse:
+    """发送消息并接收完整响应，支持图片输入输出和文件附件
+    
+    参数同 iter_chat_with_images
+    
+    Returns:
+        ChatResponse 包含文本和图片
+    """
+    result = ChatResponse()
+    for _ in iter_chat_with_images(jwt, sess_name, message, images, team_id, file_ids, result):
+        pass
+    return result
+
+
+def iter_chat_with_images(jwt: str, sess_name: str, message: str, images: List[Dict],
+                          team_id: str, file_ids: Optional[List[str]], result: ChatResponse) -> Iterator[str]:
+    """发送消息并流式接收响应，每收到一段文本就立即yield
+    
+    请求在第一次迭代时才发出；迭代结束后 result.text 为完整文本，
+    result.images 为生成的图片（图片在文本全部输出后才下载）。
     
     Args:
         jwt: JWT token
         sess_name: 会话名称
         message: 用户消息文本
         images: 图片列表 [{type: 'base64'|'url', ...}]
-        proxy: 代理地址
         team_id: 团队ID
         file_ids: Gemini 文件ID列表（用于附带已上传的文件）
+        result: 用于收集完整文本和图片的 ChatResponse
     
-    Returns:
-        ChatResponse 包含文本和图片
+    Yields:
+        增量文本
     """
     # 构建查询parts
     query_parts = [{"text": message}]
     
     # 如果有输入图片，添加到parts中
+    url_parts = {}  # 本次请求内已处理的图片URL -> inlineData part（下载失败为None）
     for img in images:
         if img.get("type") == "base64":
             query_parts.append({
@@ -687,17 +1056,22 @@ def stream_chat_with_images(jwt: str, sess_name: str, message: str, images: List
                 }
             })
         elif img.get("type") == "url":
-            # 先下载图片再转base64
-            try:
-                img_data, mime_type = download_image_from_url(img.get("url"), proxy)
-                query_parts.append({
-                    "inlineData": {
-                        "mimeType": mime_type,
-                        "data": base64.b64encode(img_data).decode("utf-8")
+            url = img.get("url")
+            if url not in url_parts:
+                # 先下载图片再转base64，同一URL只下载一次
+                url_parts[url] = None
+                try:
+                    img_data, mime_type = download_image_from_url(url)
+                    url_parts[url] = {
+                        "inlineData": {
+                            "mimeType": mime_type,
+                            "data": base64.b64encode(img_data).decode("utf-8")
+                        }
                     }
-                })
-            except Exception as e:
-                print(f"[图片] 下载输入图片失败: {e}")
+                except Exception as e:
+                    print(f"[图片] 下载输入图片失败: {e}")
+            if url_parts[url]:
+                query_parts.append(url_parts[url])
     
     # 准备请求中的文件ID列表
     request_file_ids = file_ids if file_ids else []
@@ -723,35 +1097,23 @@ def stream_chat_with_images(jwt: str, sess_name: str, message: str, images: List
         }
     }
 
-    proxies = {"http": proxy, "https": proxy} if proxy else None
-    resp = requests.post(
-        STREAM_ASSIST_URL,
-        headers=get_headers(jwt),
-        json=body,
-        proxies=proxies,
-        verify=False,
-        timeout=120,
+    client = account_manager.stream_client
+    resp = client.send(
+        client.build_request("POST", STREAM_ASSIST_URL, headers=get_headers(jwt), content=orjson.dumps(body)),
         stream=True
     )
 
     if resp.status_code != 200:
+        resp.close()
         raise Exception(f"请求失败: {resp.status_code}")
 
-    # 收集完整响应
-    full_response = ""
-    for line in resp.iter_lines():
-        if line:
-            full_response += line.decode('utf-8') + "\n"
-
-    # 解析响应
-    result = ChatResponse()
+    # 边接收边解析响应
     texts = []
-    file_ids = []  # 收集需要下载的文件 {fileId, mimeType}
+    pending_file_ids = []  # 收集需要下载的文件 {fileId, mimeType}
     current_session = None
     
     try:
-        data_list = json.loads(full_response)
-        for data in data_list:
+        for data in iter_json_array(iter_byte_lines(resp.iter_bytes())):
             sar = data.get("streamAssistResponse")
             if not sar:
                 continue
@@ -763,18 +1125,18 @@ def stream_chat_with_images(jwt: str, sess_name: str, message: str, images: List
             
             # 检查顶层的generatedImages
             for gen_img in sar.get("generatedImages", []):
-                parse_generated_image(gen_img, result, proxy)
+                parse_generated_image(gen_img, result)
             
             answer = sar.get("answer") or {}
             
             # 检查answer级别的generatedImages
             for gen_img in answer.get("generatedImages", []):
-                parse_generated_image(gen_img, result, proxy)
+                parse_generated_image(gen_img, result)
             
             for reply in answer.get("replies", []):
                 # 检查reply级别的generatedImages
                 for gen_img in reply.get("generatedImages", []):
-                    parse_generated_image(gen_img, result, proxy)
+                    parse_generated_image(gen_img, result)
                 
                 gc = reply.get("groundedContent", {})
                 content = gc.get("content", {})
@@ -784,30 +1146,33 @@ def stream_chat_with_images(jwt: str, sess_name: str, message: str, images: List
                 # 检查file字段（图片生成的关键）
                 file_info = content.get("file")
                 if file_info and file_info.get("fileId"):
-                    file_ids.append({
+                    pending_file_ids.append({
                         "fileId": file_info["fileId"],
                         "mimeType": file_info.get("mimeType", "image/png"),
                         "fileName": file_info.get("name")
                     })
                 
                 # 解析图片数据
-                parse_image_from_content(content, result, proxy)
-                parse_image_from_content(gc, result, proxy)
+                parse_image_from_content(content, result)
+                parse_image_from_content(gc, result)
                 
                 # 检查attachments
-                for att in reply.get("attachments", []) + gc.get("attachments", []) + content.get("attachments", []):
-                    parse_attachment(att, result, proxy)
+                for att in itertools.chain(reply.get("attachments") or (), gc.get("attachments") or (),
+                                           content.get("attachments") or ()):
+                    parse_attachment(att, result)
                 
                 if text and not thought:
                     texts.append(text)
+                    yield text
         
         # 处理通过fileId引用的图片
-        if file_ids and current_session:
+        if pending_file_ids and current_session:
             try:
-                file_metadata = get_session_file_metadata(jwt, current_session, team_id, proxy)
-                for finfo in file_ids:
+                file_metadata = get_session_file_metadata(jwt, current_session, team_id)
+                # 先确定每个文件的下载参数，下载线程之间不共享元数据
+                tasks = []
+                for finfo in pending_file_ids:
                     fid = finfo["fileId"]
-                    mime = finfo["mimeType"]
                     fname = finfo.get("fileName")
                     meta = file_metadata.get(fid)
                     
@@ -816,31 +1181,54 @@ def stream_chat_with_images(jwt: str, sess_name: str, message: str, images: List
                         session_path = meta.get("session") or current_session
                     else:
                         session_path = current_session
-                    
-                    try:
-                        image_data = download_file_with_jwt(jwt, session_path, fid, proxy)
-                        filename = save_image_to_cache(image_data, mime, fname)
-                        img = ChatImage(
-                            file_id=fid,
-                            file_name=filename,
-                            mime_type=mime,
-                            local_path=str(IMAGE_CACHE_DIR / filename)
-                        )
-                        result.images.append(img)
-                        print(f"[图片] 已保存: {filename}")
-                    except Exception as e:
-                        print(f"[图片] 下载失败 (fileId={fid}): {e}")
+                    tasks.append((fid, finfo["mimeType"], fname, session_path))
+                
+                def download(task):
+                    fid, mime, fname, session_path = task
+                    image_data = download_file_with_jwt(jwt, session_path, fid)
+                    filename = save_image_to_cache(image_data, mime, fname)
+                    return ChatImage(
+                        file_id=fid,
+                        file_name=filename,
+                        mime_type=mime,
+                        local_path=str(IMAGE_CACHE_DIR / filename)
+                    )
+                
+                # 并发下载，按原顺序收集结果
+                with ThreadPoolExecutor(max_workers=min(FILE_DOWNLOAD_WORKERS, len(tasks))) as executor:
+                    futures = [executor.submit(download, task) for task in tasks]
+                    for task, future in zip(tasks, futures):
+                        try:
+                            img = future.result()
+                            result.images.append(img)
+                            print(f"[图片] 已保存: {img.file_name}")
+                        except Exception as e:
+                            print(f"[图片] 下载失败 (fileId={task[0]}): {e}")
             except Exception as e:
                 print(f"[图片] 获取文件元数据失败: {e}")
                 
     except json.JSONDecodeError:
         pass
+    finally:
+        resp.close()
 
     result.text = "".join(texts)
-    return result
 
 
-def parse_generated_image(gen_img: Dict, result: ChatResponse, proxy: Optional[str] = None):
+def decode_image_base64(b64_data) -> bytes:
+    """解码图片的base64数据（str或bytes）
+    
+    使用 pybase64 的SIMD实现；validate=True 才能走快速路径，
+    数据中含换行等非base64字符时回退到宽松解码。
+    解码结果直接写入缓存，不再保留base64字符串。
+    """
+    try:
+        return pybase64.b64decode(b64_data, validate=True)
+    except binascii.Error:
+        return pybase64.b64decode(b64_data, validate=False)
+
+
+def parse_generated_image(gen_img: Dict, result: ChatResponse):
     """解析generatedImages中的图片"""
     image_data = gen_img.get("image")
     if not image_data:
@@ -850,11 +1238,10 @@ def parse_generated_image(gen_img: Dict, result: ChatResponse, proxy: Optional[s
     b64_data = image_data.get("bytesBase64Encoded")
     if b64_data:
         try:
-            decoded = base64.b64decode(b64_data)
+            decoded = decode_image_base64(b64_data)
             mime_type = image_data.get("mimeType", "image/png")
             filename = save_image_to_cache(decoded, mime_type)
             img = ChatImage(
-                base64_data=b64_data,
                 mime_type=mime_type,
                 file_name=filename,
                 local_path=str(IMAGE_CACHE_DIR / filename)
@@ -865,7 +1252,7 @@ def parse_generated_image(gen_img: Dict, result: ChatResponse, proxy: Optional[s
             print(f"[图片] 解析base64失败: {e}")
 
 
-def parse_image_from_content(content: Dict, result: ChatResponse, proxy: Optional[str] = None):
+def parse_image_from_content(content: Dict, result: ChatResponse):
     """从content中解析图片"""
     # 检查inlineData
     inline_data = content.get("inlineData")
@@ -873,11 +1260,10 @@ def parse_image_from_content(content: Dict, result: ChatResponse, proxy: Optiona
         b64_data = inline_data.get("data")
         if b64_data:
             try:
-                decoded = base64.b64decode(b64_data)
+                decoded = decode_image_base64(b64_data)
                 mime_type = inline_data.get("mimeType", "image/png")
                 filename = save_image_to_cache(decoded, mime_type)
                 img = ChatImage(
-                    base64_data=b64_data,
                     mime_type=mime_type,
                     file_name=filename,
                     local_path=str(IMAGE_CACHE_DIR / filename)
@@ -888,7 +1274,7 @@ def parse_image_from_content(content: Dict, result: ChatResponse, proxy: Optiona
                 print(f"[图片] 解析inlineData失败: {e}")
 
 
-def parse_attachment(att: Dict, result: ChatResponse, proxy: Optional[str] = None):
+def parse_attachment(att: Dict, result: ChatResponse):
     """解析attachment中的图片"""
     # 检查是否是图片类型
     mime_type = att.get("mimeType", "")
@@ -899,11 +1285,10 @@ def parse_attachment(att: Dict, result: ChatResponse, proxy: Optional[str] = Non
     b64_data = att.get("data") or att.get("bytesBase64Encoded")
     if b64_data:
         try:
-            decoded = base64.b64decode(b64_data)
+            decoded = decode_image_base64(b64_data)
             filename = att.get("name") or None
             filename = save_image_to_cache(decoded, mime_type, filename)
             img = ChatImage(
-                base64_data=b64_data,
                 mime_type=mime_type,
                 file_name=filename,
                 local_path=str(IMAGE_CACHE_DIR / filename)
@@ -916,9 +1301,22 @@ def parse_attachment(att: Dict, result: ChatResponse, proxy: Optional[str] = Non
 
 # ==================== OpenAPI 接口 ====================
 
+def json_response(data: Any, status: int = 200) -> Response:
+    """使用 orjson 序列化的JSON响应（直接输出UTF-8，比 jsonify 更快）"""
+    return Response(orjson.dumps(data), status=status, mimetype='application/json')
+
+
 @app.route('/v1/models', methods=['GET'])
 def list_models():
-    """获取模型列表"""
+    """获取模型列表（结果缓存到配置修改为止）"""
+    body = account_manager.models_response
+    if body is None:
+        body = account_manager.models_response = build_models_response()
+    return Response(body, mimetype='application/json')
+
+
+def build_models_response() -> bytes:
+    """根据配置生成序列化后的模型列表"""
     models_config = account_manager.config.get("models", [])
     models_data = []
     
@@ -945,75 +1343,75 @@ def list_models():
             "parent": None
         })
     
-    return jsonify({"object": "list", "data": models_data})
+    return orjson.dumps({"object": "list", "data": models_data})
 
 
 @app.route('/v1/files', methods=['POST'])
 def upload_file():
     """OpenAI 兼容的文件上传接口"""
-    import traceback
     request_start_time = time.time()
-    print(f"\n{'='*60}")
-    print(f"[文件上传] ===== 接口调用开始 =====")
-    print(f"[文件上传] 请求时间: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+    logger.debug("[文件上传] ===== 接口调用开始 =====")
     
     try:
         # 检查是否有文件
         step_start = time.time()
-        print(f"[文件上传] 步骤1: 检查请求中的文件...")
+        logger.debug("[文件上传] 步骤1: 检查请求中的文件...")
         if 'file' not in request.files:
-            print(f"[文件上传] 错误: 请求中没有文件")
-            return jsonify({"error": {"message": "No file provided", "type": "invalid_request_error"}}), 400
+            logger.debug("[文件上传] 错误: 请求中没有文件")
+            return json_response({"error": {"message": "No file provided", "type": "invalid_request_error"}}, 400)
         
         file = request.files['file']
         if file.filename == '':
-            print(f"[文件上传] 错误: 文件名为空")
-            return jsonify({"error": {"message": "No file selected", "type": "invalid_request_error"}}), 400
-        print(f"[文件上传] 步骤1完成: 文件名={file.filename}, 耗时={time.time()-step_start:.3f}秒")
+            logger.debug("[文件上传] 错误: 文件名为空")
+            return json_response({"error": {"message": "No file selected", "type": "invalid_request_error"}}, 400)
+        logger.debug("[文件上传] 步骤1完成: 文件名=%s, 耗时=%.3f秒", file.filename, time.time() - step_start)
         
-        # 获取文件内容和MIME类型
+        # 获取文件大小和MIME类型（文件内容在上传时流式读取，不整体读入内存）
         step_start = time.time()
-        print(f"[文件上传] 步骤2: 读取文件内容...")
-        file_content = file.read()
+        logger.debug("[文件上传] 步骤2: 获取文件信息...")
+        file_stream = file.stream
+        file_size = file_stream.seek(0, os.SEEK_END)
         mime_type = file.content_type or mimetypes.guess_type(file.filename)[0] or 'application/octet-stream'
-        print(f"[文件上传] 步骤2完成: 文件大小={len(file_content)}字节, MIME类型={mime_type}, 耗时={time.time()-step_start:.3f}秒")
+        logger.debug("[文件上传] 步骤2完成: 文件大小=%s字节, MIME类型=%s, 耗时=%.3f秒",
+                     file_size, mime_type, time.time() - step_start)
         
         # 获取账号信息
         max_retries = len(account_manager.accounts)
         last_error = None
         gemini_file_id = None
-        print(f"[文件上传] 步骤3: 开始尝试上传, 最大重试次数={max_retries}")
+        logger.debug("[文件上传] 步骤3: 开始尝试上传, 最大重试次数=%s", max_retries)
         
         for retry_idx in range(max_retries):
             retry_start = time.time()
-            print(f"\n[文件上传] --- 第{retry_idx+1}次尝试 ---")
+            attempt = retry_idx + 1
+            logger.debug("[文件上传] --- 第%s次尝试 ---", attempt)
             try:
                 # 获取账号
                 step_start = time.time()
-                print(f"[文件上传] 步骤3.{retry_idx+1}.1: 获取下一个可用账号...")
+                logger.debug("[文件上传] 步骤3.%s.1: 获取下一个可用账号...", attempt)
                 account_idx, account = account_manager.get_next_account()
-                print(f"[文件上传] 步骤3.{retry_idx+1}.1完成: 账号索引={account_idx}, CSESIDX={account.get('csesidx')}, 耗时={time.time()-step_start:.3f}秒")
+                logger.debug("[文件上传] 步骤3.%s.1完成: 账号索引=%s, CSESIDX=%s, 耗时=%.3f秒",
+                             attempt, account_idx, account.get('csesidx'), time.time() - step_start)
                 
                 # 确保会话有效
                 step_start = time.time()
-                print(f"[文件上传] 步骤3.{retry_idx+1}.2: 确保会话有效(JWT+Session)...")
+                logger.debug("[文件上传] 步骤3.%s.2: 确保会话有效(JWT+Session)...", attempt)
                 session, jwt, team_id = ensure_session_for_account(account_idx, account)
-                print(f"[文件上传] 步骤3.{retry_idx+1}.2完成: session={session}, team_id={team_id}, 耗时={time.time()-step_start:.3f}秒")
-                
-                proxy = account_manager.config.get("proxy")
-                print(f"[文件上传] 代理设置: {proxy}")
+                logger.debug("[文件上传] 步骤3.%s.2完成: session=%s, team_id=%s, 耗时=%.3f秒",
+                             attempt, session, team_id, time.time() - step_start)
                 
                 # 上传文件到 Gemini
                 step_start = time.time()
-                print(f"[文件上传] 步骤3.{retry_idx+1}.3: 上传文件到Gemini...")
-                gemini_file_id = upload_file_to_gemini(jwt, session, team_id, file_content, file.filename, mime_type, proxy)
-                print(f"[文件上传] 步骤3.{retry_idx+1}.3完成: gemini_file_id={gemini_file_id}, 耗时={time.time()-step_start:.3f}秒")
+                logger.debug("[文件上传] 步骤3.%s.3: 上传文件到Gemini...", attempt)
+                file_stream.seek(0)  # 每次重试都从头读取
+                gemini_file_id = upload_file_to_gemini(jwt, session, team_id, file_stream, file_size,
+                                                       file.filename, mime_type)
+                logger.debug("[文件上传] 步骤3.%s.3完成: gemini_file_id=%s, 耗时=%.3f秒",
+                             attempt, gemini_file_id, time.time() - step_start)
                 
                 if gemini_file_id:
                     # 生成 OpenAI 格式的 file_id
-                    step_start = time.time()
-                    print(f"[文件上传] 步骤4: 生成OpenAI格式响应...")
-                    openai_file_id = f"file-{uuid.uuid4().hex[:24]}"
+                    openai_file_id = f"file-{secrets.token_hex(12)}"
                     
                     # 保存映射关系
                     file_manager.add_file(
@@ -1022,57 +1420,43 @@ def upload_file():
                         session_name=session,
                         filename=file.filename,
                         mime_type=mime_type,
-                        size=len(file_content)
+                        size=file_size
                     )
-                    print(f"[文件上传] 步骤4完成: openai_file_id={openai_file_id}, 耗时={time.time()-step_start:.3f}秒")
-                    
-                    total_time = time.time() - request_start_time
-                    print(f"\n[文件上传] ===== 上传成功 =====")
-                    print(f"[文件上传] 总耗时: {total_time:.3f}秒")
-                    print(f"{'='*60}\n")
+                    logger.debug("[文件上传] ===== 上传成功 ===== openai_file_id=%s, 总耗时: %.3f秒",
+                                 openai_file_id, time.time() - request_start_time)
                     
                     # 返回 OpenAI 格式响应
-                    return jsonify({
+                    return json_response({
                         "id": openai_file_id,
                         "object": "file",
-                        "bytes": len(file_content),
+                        "bytes": file_size,
                         "created_at": int(time.time()),
                         "filename": file.filename,
                         "purpose": request.form.get('purpose', 'assistants')
                     })
                 else:
-                    print(f"[文件上传] 警告: gemini_file_id为空")
+                    logger.warning("[文件上传] 警告: gemini_file_id为空")
                     
             except Exception as e:
                 last_error = e
-                print(f"[文件上传] 第{retry_idx+1}次尝试失败: {type(e).__name__}: {e}")
-                print(f"[文件上传] 堆栈跟踪:\n{traceback.format_exc()}")
-                print(f"[文件上传] 本次尝试耗时: {time.time()-retry_start:.3f}秒")
+                logger.warning("[文件上传] 第%s次尝试失败 (耗时%.3f秒): %s: %s",
+                               attempt, time.time() - retry_start, type(e).__name__, e, exc_info=True)
                 continue
         
-        total_time = time.time() - request_start_time
-        print(f"\n[文件上传] ===== 所有重试均失败 =====")
-        print(f"[文件上传] 最后错误: {last_error}")
-        print(f"[文件上传] 总耗时: {total_time:.3f}秒")
-        print(f"{'='*60}\n")
-        return jsonify({"error": {"message": f"文件上传失败: {last_error}", "type": "api_error"}}), 500
+        logger.error("[文件上传] ===== 所有重试均失败 ===== 最后错误: %s, 总耗时: %.3f秒",
+                     last_error, time.time() - request_start_time)
+        return json_response({"error": {"message": f"文件上传失败: {last_error}", "type": "api_error"}}, 500)
         
     except Exception as e:
-        total_time = time.time() - request_start_time
-        print(f"\n[文件上传] ===== 发生异常 =====")
-        print(f"[文件上传] 错误类型: {type(e).__name__}")
-        print(f"[文件上传] 错误信息: {e}")
-        print(f"[文件上传] 堆栈跟踪:\n{traceback.format_exc()}")
-        print(f"[文件上传] 总耗时: {total_time:.3f}秒")
-        print(f"{'='*60}\n")
-        return jsonify({"error": {"message": str(e), "type": "api_error"}}), 500
+        logger.exception("[文件上传] ===== 发生异常 ===== 总耗时: %.3f秒", time.time() - request_start_time)
+        return json_response({"error": {"message": str(e), "type": "api_error"}}, 500)
 
 
 @app.route('/v1/files', methods=['GET'])
 def list_files():
     """获取已上传文件列表"""
     files = file_manager.list_files()
-    return jsonify({
+    return json_response({
         "object": "list",
         "data": [{
             "id": f["openai_file_id"],
@@ -1090,9 +1474,9 @@ def get_file(file_id):
     """获取文件信息"""
     file_info = file_manager.get_file(file_id)
     if not file_info:
-        return jsonify({"error": {"message": "File not found", "type": "invalid_request_error"}}), 404
+        return json_response({"error": {"message": "File not found", "type": "invalid_request_error"}}, 404)
     
-    return jsonify({
+    return json_response({
         "id": file_info["openai_file_id"],
         "object": "file",
         "bytes": file_info.get("size", 0),
@@ -1106,21 +1490,18 @@ def get_file(file_id):
 def delete_file(file_id):
     """删除文件"""
     if file_manager.delete_file(file_id):
-        return jsonify({
+        return json_response({
             "id": file_id,
             "object": "file",
             "deleted": True
         })
-    return jsonify({"error": {"message": "File not found", "type": "invalid_request_error"}}), 404
+    return json_response({"error": {"message": "File not found", "type": "invalid_request_error"}}, 404)
 
 
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
     """聊天对话接口（支持图片输入输出）"""
     try:
-        # 每次请求时清理过期图片
-        cleanup_expired_images()
-        
         data = request.json
         messages = data.get('messages', [])
         stream = data.get('stream', False)
@@ -1133,40 +1514,23 @@ def chat_completions():
         for msg in messages:
             if msg.get('role') == 'user':
                 content = msg.get('content', '')
-                text, images = extract_images_from_openai_content(content)
+                if isinstance(content, str):
+                    # 纯文本消息（最常见）无需解析图片和文件
+                    if content:
+                        user_message = content
+                    continue
+                text, images, file_ids = extract_images_from_openai_content(content)
                 if text:
                     user_message = text
                 input_images.extend(images)
-                
-                # 提取文件ID（支持多种格式）
-                if isinstance(content, list):
-                    for item in content:
-                        if isinstance(item, dict):
-                            print(f"[调试] 发现文件项: {item}")
-                            # 格式1: {"type": "file", "file_id": "xxx"}
-                            if item.get('type') == 'file' and item.get('file_id'):
-                                input_file_ids.append(item['file_id'])
-                            # 格式2: {"type": "file", "file": {"file_id": "xxx"}}
-                            elif item.get('type') == 'file' and isinstance(item.get('file'), dict):
-                                file_obj = item['file']
-                                # 支持 file_id 或 id 两种字段名
-                                fid = file_obj.get('file_id') or file_obj.get('id')
-                                if fid:
-                                    input_file_ids.append(fid)
+                input_file_ids.extend(file_ids)
         
         # 将 OpenAI file_id 转换为 Gemini fileId
-        gemini_file_ids = []
-        print(f"[调试] 输入的OpenAI文件ID: {input_file_ids}")
-        for fid in input_file_ids:
-            gemini_fid = file_manager.get_gemini_file_id(fid)
-            if gemini_fid:
-                gemini_file_ids.append(gemini_fid)
-            else:
-                print(f"[警告] 未找到文件映射: {fid}")
-        print(f"[调试] 转换后的Gemini文件ID: {gemini_file_ids}")
+        gemini_file_ids = file_manager.get_gemini_file_ids(input_file_ids)
+        logger.debug("[调试] 输入的OpenAI文件ID: %s, 转换后的Gemini文件ID: %s", input_file_ids, gemini_file_ids)
         
         if not user_message and not input_images and not gemini_file_ids:
-            return jsonify({"error": "No user message found"}), 400
+            return json_response({"error": "No user message found"}, 400)
         
         # 轮训获取账号
         max_retries = len(account_manager.accounts)
@@ -1179,25 +1543,30 @@ def chat_completions():
                 csesidx = account.get("csesidx", "unknown")
                 print(f"[调度] 当前使用账号CSESIDX: {csesidx}")
                 session, jwt, team_id = ensure_session_for_account(account_idx, account)
-                proxy = account_manager.config.get("proxy")
                 
                 # 发送请求（支持图片和文件）
-                chat_response = stream_chat_with_images(jwt, session, user_message, input_images, proxy, team_id, gemini_file_ids)
+                if stream:
+                    chat_response = ChatResponse()
+                    deltas = iter_chat_with_images(jwt, session, user_message, input_images, team_id,
+                                                   gemini_file_ids, chat_response)
+                    # 在重试循环内取得第一段文本，请求失败时仍可换下一个账号
+                    first_delta = next(deltas, None)
+                else:
+                    chat_response = stream_chat_with_images(jwt, session, user_message, input_images, team_id, gemini_file_ids)
                 break
             except Exception as e:
                 last_error = e
                 continue
         else:
             # 所有账号都失败
-            return jsonify({"error": f"所有账号请求失败: {last_error}"}), 500
-
-        # 构建响应内容（包含图片）
-        response_content = build_openai_response_content(chat_response, request.host_url)
+            return json_response({"error": f"所有账号请求失败: {last_error}"}, 500)
 
         if stream:
-            # 流式响应
-            def generate():
-                chunk_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+            # 流式响应：上游每返回一段文本就转发一个chunk，图片URL在文本结束后追加
+            host_url = request.host_url
+            chunk_id = f"chatcmpl-{secrets.token_hex(4)}"
+            
+            def make_chunk(delta: dict, finish_reason: Optional[str] = None) -> bytes:
                 chunk = {
                     "id": chunk_id,
                     "object": "chat.completion.chunk",
@@ -1205,32 +1574,55 @@ def chat_completions():
                     "model": "gemini-enterprise",
                     "choices": [{
                         "index": 0,
-                        "delta": {"content": response_content},
-                        "finish_reason": None
+                        "delta": delta,
+                        "finish_reason": finish_reason
                     }]
                 }
-                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-                
-                # 结束标记
-                end_chunk = {
-                    "id": chunk_id,
-                    "object": "chat.completion.chunk",
-                    "created": int(time.time()),
-                    "model": "gemini-enterprise",
-                    "choices": [{
-                        "index": 0,
-                        "delta": {},
-                        "finish_reason": "stop"
-                    }]
-                }
-                yield f"data: {json.dumps(end_chunk, ensure_ascii=False)}\n\n"
-                yield "data: [DONE]\n\n"
-
-            return Response(generate(), mimetype='text/event-stream')
+                # 直接拼接 orjson 输出的bytes，无需再经过 str 编码
+                return b"data: " + orjson.dumps(chunk) + b"\n\n"
+            
+            def generate():
+                try:
+                    has_text = first_delta is not None
+                    if has_text:
+                        yield make_chunk({"content": first_delta})
+                    try:
+                        for delta in deltas:
+                            has_text = True
+                            yield make_chunk({"content": delta})
+                    except Exception as e:
+                        # 已经输出了部分内容，无法换账号重试，明确告知客户端响应不完整
+                        logger.error("[对话] 流式响应中断: %s", e)
+                        error = {"error": {"message": f"上游响应中断: {e}", "type": "api_error"}}
+                        yield b"data: " + orjson.dumps(error) + b"\n\n"
+                        yield b"data: [DONE]\n\n"
+                        return
+                    
+                    image_urls = build_image_urls(chat_response, host_url)
+                    if image_urls:
+                        image_text = "\n".join(image_urls)
+                        yield make_chunk({"content": f"\n\n{image_text}" if has_text else image_text})
+                    
+                    # 结束标记
+                    yield make_chunk({}, "stop")
+                    yield b"data: [DONE]\n\n"
+                finally:
+                    # 客户端断开时也要关闭上游流，释放连接
+                    deltas.close()
+
+            response = Response(generate(), mimetype='text/event-stream')
+            # generate() 尚未开始迭代就断开时其 finally 不会执行，在响应关闭时再确保关闭一次
+            response.call_on_close(deltas.close)
+            return response
         else:
-            # 非流式响应
+            # 构建响应内容（包含图片）
+            response_content = build_openai_response_content(chat_response, request.host_url)
+            
+            # 非流式响应（用量按字符数近似，不做分词）
+            prompt_tokens = len(user_message)
+            completion_tokens = len(chat_response.text)
             response = {
-                "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
+                "id": f"chatcmpl-{secrets.token_hex(4)}",
                 "object": "chat.completion",
                 "created": int(time.time()),
                 "model": "gemini-enterprise",
@@ -1243,17 +1635,17 @@ def chat_completions():
                     "finish_reason": "stop"
                 }],
                 "usage": {
-                    "prompt_tokens": len(user_message),
-                    "completion_tokens": len(chat_response.text),
-                    "total_tokens": len(user_message) + len(chat_response.text)
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens
                 }
             }
-            return jsonify(response)
+            return json_response(response)
 
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
 
 
 def get_image_base_url(fallback_host_url: str) -> str:
@@ -1261,13 +1653,15 @@ def get_image_base_url(fallback_host_url: str) -> str:
     
     优先使用配置文件中的 image_base_url，否则使用请求的 host_url
     """
-    configured_url = account_manager.config.get("image_base_url", "").strip()
-    if configured_url:
-        # 确保以 / 结尾
-        if not configured_url.endswith("/"):
-            configured_url += "/"
-        return configured_url
-    return fallback_host_url
+    return account_manager.image_base_url or fallback_host_url
+
+
+def build_image_urls(chat_response: ChatResponse, host_url: str) -> List[str]:
+    """获取响应中已缓存图片的访问URL列表"""
+    if not chat_response.images:
+        return []
+    image_prefix = f"{get_image_base_url(host_url)}image/"
+    return [image_prefix + img.file_name for img in chat_response.images if img.file_name]
 
 
 def build_openai_response_content(chat_response: ChatResponse, host_url: str) -> str:
@@ -1278,20 +1672,12 @@ def build_openai_response_content(chat_response: ChatResponse, host_url: str) ->
     result_text = chat_response.text
     
     # 如果有图片，将图片URL追加到文本中
-    if chat_response.images:
-        base_url = get_image_base_url(host_url)
-        image_urls = []
-        
-        for img in chat_response.images:
-            if img.file_name:
-                image_url = f"{base_url}image/{img.file_name}"
-                image_urls.append(image_url)
-        
-        if image_urls:
-            # 在文本末尾添加图片URL
-            if result_text:
-                result_text += "\n\n"
-            result_text += "\n".join(image_urls)
+    image_urls = build_image_urls(chat_response, host_url)
+    if image_urls:
+        # 在文本末尾添加图片URL
+        if result_text:
+            result_text += "\n\n"
+        result_text += "\n".join(image_urls)
     
     return result_text
 
@@ -1301,26 +1687,23 @@ def build_openai_response_content(chat_response: ChatResponse, host_url: str) ->
 @app.route('/image/<path:filename>')
 def serve_image(filename):
     """提供缓存图片的访问"""
-    # 安全检查：防止路径遍历
-    if '..' in filename or filename.startswith('/'):
+    # 安全检查：规范化后的路径必须仍在缓存目录内，防止路径遍历
+    if not (IMAGE_CACHE_ROOT / filename).resolve().is_relative_to(IMAGE_CACHE_ROOT):
         abort(404)
-    
-    filepath = IMAGE_CACHE_DIR / filename
-    if not filepath.exists():
+    # ETag记录文件只在服务端使用，不对外提供
+    if filename.lower().endswith(IMAGE_ETAG_SUFFIX):
         abort(404)
     
-    # 确定Content-Type
-    ext = filepath.suffix.lower()
-    mime_types = {
-        '.png': 'image/png',
-        '.jpg': 'image/jpeg',
-        '.jpeg': 'image/jpeg',
-        '.gif': 'image/gif',
-        '.webp': 'image/webp',
-    }
-    mime_type = mime_types.get(ext, 'application/octet-stream')
+    # 使用保存时计算的sha256作为ETag，没有记录时退回Werkzeug默认的ETag
+    try:
+        etag = (IMAGE_CACHE_ROOT / f"{filename}{IMAGE_ETAG_SUFFIX}").read_text(encoding="ascii")
+    except OSError:
+        etag = True
     
-    return send_from_directory(IMAGE_CACHE_DIR, filename, mimetype=mime_type)
+    # Content-Type 由扩展名推断，文件不存在时直接返回404
+    # 缓存文件名随机生成、内容不会变化，允许浏览器在缓存期内直接复用，过期后条件请求返回304
+    return send_from_directory(IMAGE_CACHE_DIR, filename, etag=etag,
+                               max_age=IMAGE_CACHE_HOURS * 3600, conditional=True)
 
 
 @app.route('/health', methods=['GET'])
@@ -1344,7 +1727,7 @@ def system_status():
         },
         "proxy": {
             "url": proxy,
-            "available": check_proxy(proxy) if proxy else False
+            "available": cached_check_proxy(proxy) if proxy else False
         },
         "models": account_manager.config.get("models", [])
     })
@@ -1398,14 +1781,10 @@ def add_account():
     
     account_manager.accounts.append(new_account)
     idx = len(account_manager.accounts) - 1
-    account_manager.account_states[idx] = {
-        "jwt": None,
-        "jwt_time": 0,
-        "session": None,
-        "available": True
-    }
+    account_manager.account_states[idx] = AccountManager.create_account_state(new_account)
     account_manager.config["accounts"] = account_manager.accounts
-    account_manager.save_config()
+    account_manager.refresh_available_accounts()
+    account_manager.mark_dirty()
     
     return jsonify({"success": True, "id": idx})
 
@@ -1419,6 +1798,17 @@ def update_account(account_id):
     data = request.json
     acc = account_manager.accounts[account_id]
     
+    # 凭据变化后，用旧凭据获取的JWT和会话都不能再用
+    if any(key in data and data[key] != acc.get(key) for key in ("csesidx", "secure_c_ses", "host_c_oses")):
+        state = account_manager.account_states[account_id]
+        with state["jwt_lock"]:
+            state["jwt"] = None
+            state["jwt_time"] = 0
+            state["jwt_exp"] = 0
+            state["session"] = None
+            with account_manager.lock:
+                acc.pop("cached_jwt", None)
+    
     if "team_id" in data:
         acc["team_id"] = data["team_id"]
     if "secure_c_ses" in data:
@@ -1432,7 +1822,7 @@ def update_account(account_id):
     
     # 同步更新config中的accounts
     account_manager.config["accounts"] = account_manager.accounts
-    account_manager.save_config()
+    account_manager.mark_dirty()
     return jsonify({"success": True})
 
 
@@ -1443,16 +1833,14 @@ def delete_account(account_id):
         return jsonify({"error": "账号不存在"}), 404
     
     account_manager.accounts.pop(account_id)
-    # 重建状态映射
-    new_states = {}
-    for i in range(len(account_manager.accounts)):
-        if i < account_id:
-            new_states[i] = account_manager.account_states.get(i, {})
-        else:
-            new_states[i] = account_manager.account_states.get(i + 1, {})
-    account_manager.account_states = new_states
+    # 只平移被删除账号之后的状态，前面的保持不动
+    states = account_manager.account_states
+    for i in range(account_id, len(account_manager.accounts)):
+        states[i] = states.pop(i + 1, {})
+    states.pop(len(account_manager.accounts), None)
     account_manager.config["accounts"] = account_manager.accounts
-    account_manager.save_config()
+    account_manager.refresh_available_accounts()
+    account_manager.mark_dirty()
     
     return jsonify({"success": True})
 
@@ -1473,7 +1861,8 @@ def toggle_account(account_id):
         account_manager.accounts[account_id].pop("unavailable_reason", None)
         account_manager.accounts[account_id].pop("unavailable_time", None)
     
-    account_manager.save_config()
+    account_manager.refresh_available_accounts()
+    account_manager.mark_dirty()
     return jsonify({"success": True, "available": not current})
 
 
@@ -1484,10 +1873,9 @@ def test_account(account_id):
         return jsonify({"error": "账号不存在"}), 404
     
     account = account_manager.accounts[account_id]
-    proxy = account_manager.config.get("proxy")
     
     try:
-        jwt = get_jwt_for_account(account, proxy)
+        jwt = get_jwt_for_account(account)
         return jsonify({"success": True, "message": "JWT获取成功"})
     except Exception as e:
         return jsonify({"success": False, "message": str(e)})
@@ -1517,7 +1905,7 @@ def add_model():
         account_manager.config["models"] = []
     
     account_manager.config["models"].append(new_model)
-    account_manager.save_config()
+    account_manager.mark_dirty()
     
     return jsonify({"success": True})
 
@@ -1539,7 +1927,7 @@ def update_model(model_id):
                 model["max_tokens"] = data["max_tokens"]
             if "enabled" in data:
                 model["enabled"] = data["enabled"]
-            account_manager.save_config()
+            account_manager.mark_dirty()
             return jsonify({"success": True})
     
     return jsonify({"error": "模型不存在"}), 404
@@ -1552,7 +1940,7 @@ def delete_model(model_id):
     for i, model in enumerate(models):
         if model.get("id") == model_id:
             models.pop(i)
-            account_manager.save_config()
+            account_manager.mark_dirty()
             return jsonify({"success": True})
     
     return jsonify({"error": "模型不存在"}), 404
@@ -1570,7 +1958,8 @@ def update_config():
     data = request.json
     if "proxy" in data:
         account_manager.config["proxy"] = data["proxy"]
-    account_manager.save_config()
+        account_manager.set_proxy(data["proxy"])
+    account_manager.mark_dirty()
     return jsonify({"success": True})
 
 
@@ -1584,14 +1973,11 @@ def import_config():
         # 重建账号状态
         account_manager.account_states = {}
         for i, acc in enumerate(account_manager.accounts):
-            available = acc.get("available", True)
-            account_manager.account_states[i] = {
-                "jwt": None,
-                "jwt_time": 0,
-                "session": None,
-                "available": available
-            }
-        account_manager.save_config()
+            account_manager.account_states[i] = AccountManager.create_account_state(acc)
+        account_manager.set_proxy(data.get("proxy"))
+        account_manager.set_image_base_url(data.get("image_base_url"))
+        account_manager.refresh_available_accounts()
+        account_manager.mark_dirty()
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"error": str(e)}), 400
@@ -1620,7 +2006,7 @@ def get_proxy_status():
     if not proxy:
         return jsonify({"enabled": False, "url": None, "available": False})
     
-    available = check_proxy(proxy)
+    available = cached_check_proxy(proxy)
     return jsonify({
         "enabled": True,
         "url": proxy,
@@ -1631,11 +2017,33 @@ def get_proxy_status():
 @app.route('/api/config/export', methods=['GET'])
 def export_config():
     """导出配置"""
+    account_manager.flush_config()
     return jsonify(account_manager.config)
 
 
+def jwt_warmup_loop():
+    """后台定时预热JWT"""
+    while True:
+        try:
+            account_manager.warm_jwts()
+        except Exception as e:
+            logger.error("[JWT预热] 失败: %s", e)
+        time.sleep(JWT_WARM_INTERVAL)
+
+
+def image_cleanup_loop():
+    """后台定时清理过期图片"""
+    while True:
+        try:
+            cleanup_expired_images()
+        except Exception as e:
+            logger.error("[图片缓存] 清理失败: %s", e)
+        time.sleep(IMAGE_CLEANUP_INTERVAL)
+
+
 def print_startup_info():
     """打印启动信息"""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
     print("="*60)
     print("Business Gemini OpenAPI 服务 (多账号轮训版)")
     print("支持图片输入输出 (OpenAI格式)")
@@ -1652,6 +2060,8 @@ def print_startup_info():
     
     # 加载配置
     account_manager.load_config()
+    # 退出前写入尚未保存的配置修改
+    atexit.register(account_manager.flush_config)
     
     # 代理信息
     proxy = account_manager.config.get("proxy")
@@ -1696,10 +2106,18 @@ def print_startup_info():
     print("启动服务...")
 
 
-if __name__ == '__main__':
+def init_app():
+    """加载配置并启动后台任务（开发服务器和 wsgi.py 共用）"""
     print_startup_info()
     
     if not account_manager.accounts:
         print("[!] 警告: 没有配置任何账号")
     
-    app.run(host='0.0.0.0', port=8000, debug=False)
\ No newline at end of file
+    threading.Thread(target=jwt_warmup_loop, daemon=True).start()
+    threading.Thread(target=image_cleanup_loop, daemon=True).start()
+
+
+if __name__ == '__main__':
+    init_app()
+    # 开发服务器，生产环境请使用 wsgi.py（gunicorn + gevent）
+    app.run(host='0.0.0.0', port=8000, debug=False, threaded=True)
\ No newline at end of file
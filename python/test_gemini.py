@@ -0,0 +1,136 @@
+"""gemini.py 的回归测试，在 python 目录下运行: python -m pytest -q"""
+import base64
+import io
+import json
+import mimetypes
+import os
+import random
+import time
+
+import httpx
+import orjson
+import pytest
+
+import gemini
+
+
+def test_stream_text_with_unicode_line_separators():
+    # U+2028 / U+0085 可以不经转义出现在JSON字符串中，不能被当作换行切分
+    text = "第一行 第二行\u0085第三行"
+    items = [
+        {"streamAssistResponse": {"answer": {"replies": [
+            {"groundedContent": {"content": {"text": text}}}]}}},
+        {"streamAssistResponse": {"answer": {"replies": [
+            {"groundedContent": {"content": {"text": "结束"}}}]}}},
+    ]
+    body = b"[" + b",\n".join(orjson.dumps(item) for item in items) + b"]\n"
+    resp = httpx.Response(200, content=body)
+    
+    # 分块大小设为1，确保多字节字符和换行跨块时也能正确拼接
+    parsed = list(gemini.iter_json_array(gemini.iter_byte_lines(resp.iter_bytes(chunk_size=1))))
+    
+    assert parsed == items
+
+
+def test_iter_byte_lines_handles_crlf_and_missing_trailing_newline():
+    chunks = [b"[{\"a\": 1},\r\n", b"{\"b\": \"\xe4\xbd", b"\xa0\"}]"]
+    assert list(gemini.iter_byte_lines(chunks)) == ['[{"a": 1},', '{"b": "你"}]']
+
+
+def test_large_single_line_element_in_small_chunks():
+    # 生成图片时上游会返回数MB的单行base64，按HTTP/2 DATA帧大小（16KB）分块到达
+    b64 = "QUJD" * (5 * 1024 * 1024)  # 20MB
+    item = {"streamAssistResponse": {"answer": {"replies": [
+        {"groundedContent": {"content": {"inlineData": {"mimeType": "image/png", "data": b64}}}}]}}}
+    body = b"[" + orjson.dumps(item) + b",\n" + orjson.dumps({"b": 1}) + b"]\n"
+    chunks = [body[i:i + 16 * 1024] for i in range(0, len(body), 16 * 1024)]
+    
+    start = time.perf_counter()
+    parsed = list(gemini.iter_json_array(gemini.iter_byte_lines(chunks)))
+    elapsed = time.perf_counter() - start
+    
+    assert parsed == [item, {"b": 1}]
+    # 逐块拼接整个缓冲区是平方复杂度（约数秒），线性实现远低于该值
+    assert elapsed < 2
+
+
+class ShortReader(io.BytesIO):
+    """每次最多返回 limit 字节，模拟网络/临时文件的短读"""
+    
+    def __init__(self, data: bytes, limit: int):
+        super().__init__(data)
+        self.limit = limit
+    
+    def read(self, size: int = -1) -> bytes:
+        return super().read(min(size, self.limit) if size >= 0 else self.limit)
+
+
+def make_upload_body() -> dict:
+    return {
+        "addContextFileRequest": {
+            "fileContents": None,
+            "fileName": "a.bin",
+            "mimeType": "application/octet-stream",
+            "name": "sessions/1"
+        },
+        "additionalParams": {"token": "-"},
+        "configId": "team"
+    }
+
+
+@pytest.mark.parametrize("size", [0, 1, 2, 3, gemini.UPLOAD_CHUNK_SIZE, gemini.UPLOAD_CHUNK_SIZE + 1, 200_000])
+@pytest.mark.parametrize("limit", [None, 1000])
+def test_upload_body_matches_orjson(size, limit):
+    data = os.urandom(size)
+    file_obj = io.BytesIO(data) if limit is None else ShortReader(data, limit)
+    expected_body = make_upload_body()
+    expected_body["addContextFileRequest"]["fileContents"] = base64.b64encode(data).decode()
+    expected = orjson.dumps(expected_body)
+    
+    upload_body = gemini.UploadBody(make_upload_body(), file_obj, size)
+    
+    assert b"".join(upload_body) == expected
+    assert len(upload_body) == len(expected)
+
+
+def kq_encode_reference(s: str) -> str:
+    """原先逐字符实现的kQ编码，作为对照"""
+    byte_arr = bytearray()
+    for char in s:
+        val = ord(char)
+        if val > 255:
+            byte_arr.append(val & 255)
+            byte_arr.append(val >> 8)
+        else:
+            byte_arr.append(val)
+    return gemini.url_safe_b64encode(bytes(byte_arr))
+
+
+def test_kq_encode_matches_reference_loop():
+    rng = random.Random(0)
+    # 单字节字符与BMP内的宽字符混合（原实现不支持BMP以外的字符，代理区码点也不是合法字符）
+    pools = [range(0x00, 0x100), range(0x100, 0xD800), range(0xE000, 0x10000)]
+    samples = ["", "ascii only", "é ÿ\x00\xff", "中文", "a中b文c", '{"kid":"键"}']
+    for _ in range(500):
+        samples.append("".join(chr(rng.choice(rng.choice(pools))) for _ in range(rng.randint(1, 40))))
+    
+    for s in samples:
+        assert gemini.kq_encode(s) == kq_encode_reference(s), repr(s)
+
+
+@pytest.mark.parametrize("obj", [
+    {"alg": "HS256", "typ": "JWT", "kid": "key-1"},
+    {"sub": "csesidx/123", "iat": 1700000000, "exp": 1700000300},
+    {"a": "中文"},
+    {"kid": "éÿ", "sub": "csesidx/混合abc"},
+])
+def test_encode_jwt_segment_matches_json_dumps(obj):
+    expected = kq_encode_reference(json.dumps(obj, separators=(',', ':')))
+    assert gemini.encode_jwt_segment(obj) == expected
+
+
+def test_image_mime_types_registered():
+    # 不依赖系统 /etc/mime.types
+    for mime, ext in gemini.IMAGE_EXT_MAP.items():
+        assert mimetypes.guess_type(f"a{ext}")[0] == mime
+    assert mimetypes.guess_type("a.jpeg")[0] == "image/jpeg"
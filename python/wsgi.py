@@ -0,0 +1,17 @@
+"""生产环境入口（gunicorn + gevent）
+
+启动方式（在 python 目录下执行）:
+
+    gunicorn -k gevent -w 1 --worker-connections 200 -b 0.0.0.0:8000 wsgi:app
+
+账号轮训状态、JWT、会话和上传文件映射都保存在进程内存中，
+因此只能使用单个 worker，并发由 gevent 协程提供。
+"""
+from gevent import monkey
+
+# 必须在导入 requests / httpx / ssl 之前打补丁，上游请求的阻塞I/O才能让出协程
+monkey.patch_all()
+
+from gemini import app, init_app  # noqa: E402,F401
+
+init_app()